@@ -13,6 +13,9 @@ class Position:
     """Represents a Position in a text file: (0 based line index, 0 based column
     index) and provides methods for moving them around."""
 
+    # Positions are created for every token and text object boundary.
+    __slots__ = ("line", "col")
+
     def __init__(self, line, col):
         self.line = line
         self.col = col
@@ -47,8 +47,7 @@ def tokenize_snippet_text(
 
     def _do_parse(parent, text, allowed_tokens):
         """Recursive function that actually creates the objects."""
-        tokens = list(tokenize(text, indent, parent.start, allowed_tokens))
-        for token in tokens:
+        for token in tokenize(text, indent, parent.start, allowed_tokens):
             all_tokens.append((parent, token))
             if isinstance(token, TabStopToken):
                 ts = TabStop(parent, token)
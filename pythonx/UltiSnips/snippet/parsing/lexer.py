@@ -4,65 +4,90 @@
 """Not really a lexer in the classical sense, but code to convert snippet
 definitions into logical units called Tokens."""
 
-import string
 import re
 
 from UltiSnips.position import Position
 from UltiSnips.text import unescape
 
+# The tokenizer works directly on the internals of _TextIterator.
+# pylint: disable=protected-access
+
+
+class _EndOfText(Exception):
+
+    """Raised when a token runs into the end of the text before it is
+    complete."""
+
 
 class _TextIterator:
 
-    """Helper class to make iterating over text easier."""
+    """Helper class to make iterating over text easier.
+
+    The tokens in this module scan '_text' from '_idx' directly where that is
+    cheaper than going through the methods.
+    """
 
     def __init__(self, text, offset):
         self._text = text
-        self._line = offset.line
-        self._col = offset.col
-
+        self._len = len(text)
         self._idx = 0
 
-    def __iter__(self):
-        """Iterator interface."""
-        return self
-
-    def __next__(self):
-        """Returns the next character."""
-        if self._idx >= len(self._text):
-            raise StopIteration
-
-        rv = self._text[self._idx]
-        if self._text[self._idx] in ("\n", "\r\n"):
-            self._line += 1
-            self._col = 0
-        else:
-            self._col += 1
-        self._idx += 1
-        return rv
-
-    def peek(self, count=1):
-        """Returns the next 'count' characters without advancing the stream."""
-        if count > 1:  # This might return '' if nothing is found
-            return self._text[self._idx : self._idx + count]
-        try:
-            return self._text[self._idx]
-        except IndexError:
-            return None
+        # Line and column of '_line_idx'. They are only brought up to date
+        # with '_idx' when 'pos' is read, so moving costs no newline checks.
+        self._line = offset.line
+        self._col = offset.col
+        self._line_idx = 0
+
+    def advance(self):
+        """Returns the next character and moves past it. Raises _EndOfText
+        at the end of the text."""
+        idx = self._idx
+        if idx >= self._len:
+            raise _EndOfText
+        self._idx = idx + 1
+        return self._text[idx]
+
+    def peek_char(self):
+        """Returns the next character without advancing the stream or '' at
+        the end of the text."""
+        return self._text[self._idx] if self._idx < self._len else ""
+
+    def skip(self, count):
+        """Moves past the next 'count' characters, which the caller knows to be
+        there."""
+        self._idx += count
+
+    def advance_to(self, idx):
+        """Moves the stream forward to 'idx'."""
+        self._idx = idx
 
     @property
     def pos(self):
         """Current position in the text."""
+        idx = self._idx
+        last_idx = self._line_idx
+        if idx != last_idx:
+            newlines = self._text.count("\n", last_idx, idx)
+            if newlines:
+                self._line += newlines
+                self._col = idx - self._text.rfind("\n", last_idx, idx) - 1
+            else:
+                self._col += idx - last_idx
+            self._line_idx = idx
         return Position(self._line, self._col)
 
 
+_DIGITS = re.compile(r"[0-9]*")
+_BRACES = re.compile(r"\\[{}]|[{}]")
+
+
 def _parse_number(stream):
     """Expects the stream to contain a number next, returns the number without
     consuming any more bytes."""
-    rv = ""
-    while stream.peek() and stream.peek() in string.digits:
-        rv += next(stream)
-
-    return int(rv)
+    start = stream._idx
+    end = _DIGITS.match(stream._text, start).end()
+    stream.advance_to(end)
+    return int(stream._text[start:end])
 
 
 def _parse_till_closing_brace(stream):
@@ -72,21 +97,21 @@ def _parse_till_closing_brace(stream):
 
     Will also consume the closing }, but not return it
     """
-    rv = ""
+    text = stream._text
+    start = stream._idx
     in_braces = 1
-    while True:
-        if EscapeCharToken.starts_here(stream, "{}"):
-            rv += next(stream) + next(stream)
-        else:
-            char = next(stream)
-            if char == "{":
-                in_braces += 1
-            elif char == "}":
-                in_braces -= 1
+    for match in _BRACES.finditer(text, start):
+        brace = match.group()
+        if brace == "{":
+            in_braces += 1
+        elif brace == "}":
+            in_braces -= 1
             if in_braces == 0:
-                break
-            rv += char
-    return rv
+                end = match.start()
+                stream.advance_to(end + 1)
+                return text[start:end]
+    stream.advance_to(stream._len)
+    raise _EndOfText
 
 
 def _parse_till_unescaped_char(stream, chars):
@@ -96,25 +121,45 @@ def _parse_till_unescaped_char(stream, chars):
     Will also consume the closing char, but and return it as second
     return value
     """
-    rv = ""
+    text = stream._text
+    start = idx = stream._idx
     while True:
-        escaped = False
+        end = -1
         for char in chars:
-            if EscapeCharToken.starts_here(stream, char):
-                rv += next(stream) + next(stream)
-                escaped = True
-        if not escaped:
-            char = next(stream)
-            if char in chars:
-                break
-            rv += char
-    return rv, char
+            found = text.find(char, idx)
+            if found != -1 and (end == -1 or found < end):
+                end = found
+        if end == -1:
+            stream.advance_to(stream._len)
+            raise _EndOfText
+        # A backslash cannot be one of 'chars', so a single one right before
+        # the char is what escapes it.
+        if end > start and text[end - 1] == "\\":
+            idx = end + 1
+            continue
+        stream.advance_to(end + 1)
+        return text[start:end], text[end]
+
+
+_INDENT_REGEXES = {}
+
+
+def _indent_regex(indent):
+    """Returns a regex matching 'indent' at the beginning of each line. They
+    are cached as most snippets are expanded at the same few indents."""
+    rv = _INDENT_REGEXES.get(indent)
+    if rv is None:
+        rv = _INDENT_REGEXES[indent] = re.compile("^" + re.escape(indent), re.M)
+    return rv
 
 
 class Token:
 
     """Represents a Token as parsed from a snippet definition."""
 
+    # The character every occurrence of this token starts with.
+    FIRST_CHAR = None
+
     def __init__(self, gen, indent):
         self.initial_text = ""
         self.start = gen.pos
@@ -130,22 +175,24 @@ class TabStopToken(Token):
 
     """${1:blub}"""
 
-    CHECK = re.compile(r"^\${\d+[:}]")
+    FIRST_CHAR = "$"
+    CHECK = re.compile(r"\${\d+[:}]")
+    _CHECK_MATCH = CHECK.match
 
     @classmethod
     def starts_here(cls, stream):
         """Returns true if this token starts at the current position in
         'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+        idx = stream._idx
+        return cls._CHECK_MATCH(stream._text, idx, idx + 10) is not None
 
     def _parse(self, stream, indent):
-        next(stream)  # $
-        next(stream)  # {
+        stream.skip(2)  # ${
 
         self.number = _parse_number(stream)
 
-        if stream.peek() == ":":
-            next(stream)
+        if stream.peek_char() == ":":
+            stream.advance()
         self.initial_text = _parse_till_closing_brace(stream)
 
     def __repr__(self):
@@ -161,20 +208,22 @@ class VisualToken(Token):
 
     """${VISUAL}"""
 
-    CHECK = re.compile(r"^\${VISUAL[:}/]")
+    FIRST_CHAR = "$"
+    CHECK = re.compile(r"\${VISUAL[:}/]")
+    _CHECK_MATCH = CHECK.match
 
     @classmethod
     def starts_here(cls, stream):
         """Returns true if this token starts at the current position in
         'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+        idx = stream._idx
+        return cls._CHECK_MATCH(stream._text, idx, idx + 10) is not None
 
     def _parse(self, stream, indent):
-        for _ in range(8):  # ${VISUAL
-            next(stream)
+        stream.skip(8)  # ${VISUAL
 
-        if stream.peek() == ":":
-            next(stream)
+        if stream.peek_char() == ":":
+            stream.advance()
         self.alternative_text, char = _parse_till_unescaped_char(stream, "/}")
         self.alternative_text = unescape(self.alternative_text)
 
@@ -183,7 +232,7 @@ class VisualToken(Token):
                 self.search = _parse_till_unescaped_char(stream, "/")[0]
                 self.replace = _parse_till_unescaped_char(stream, "/")[0]
                 self.options = _parse_till_closing_brace(stream)
-            except StopIteration:
+            except _EndOfText:
                 raise RuntimeError(
                     "Invalid ${VISUAL} transformation! Forgot to escape a '/'?"
                 )
@@ -200,21 +249,23 @@ class TransformationToken(Token):
 
     """${1/match/replace/options}"""
 
-    CHECK = re.compile(r"^\${\d+\/")
+    FIRST_CHAR = "$"
+    CHECK = re.compile(r"\${\d+\/")
+    _CHECK_MATCH = CHECK.match
 
     @classmethod
     def starts_here(cls, stream):
         """Returns true if this token starts at the current position in
         'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+        idx = stream._idx
+        return cls._CHECK_MATCH(stream._text, idx, idx + 10) is not None
 
     def _parse(self, stream, indent):
-        next(stream)  # $
-        next(stream)  # {
+        stream.skip(2)  # ${
 
         self.number = _parse_number(stream)
 
-        next(stream)  # /
+        stream.advance()  # /
 
         self.search = _parse_till_unescaped_char(stream, "/")[0]
         self.replace = _parse_till_unescaped_char(stream, "/")[0]
@@ -234,16 +285,19 @@ class MirrorToken(Token):
 
     """$1."""
 
-    CHECK = re.compile(r"^\$\d+")
+    FIRST_CHAR = "$"
+    CHECK = re.compile(r"\$\d+")
+    _CHECK_MATCH = CHECK.match
 
     @classmethod
     def starts_here(cls, stream):
         """Returns true if this token starts at the current position in
         'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+        idx = stream._idx
+        return cls._CHECK_MATCH(stream._text, idx, idx + 10) is not None
 
     def _parse(self, stream, indent):
-        next(stream)  # $
+        stream.advance()  # $
         self.number = _parse_number(stream)
 
     def __repr__(self):
@@ -257,17 +311,19 @@ class ChoicesToken(Token):
          so its content will not be parsed recursively.
     """
 
-    CHECK = re.compile(r"^\${\d+\|")
+    FIRST_CHAR = "$"
+    CHECK = re.compile(r"\${\d+\|")
+    _CHECK_MATCH = CHECK.match
 
     @classmethod
     def starts_here(cls, stream):
         """Returns true if this token starts at the current position in
         'stream'."""
-        return cls.CHECK.match(stream.peek(10)) is not None
+        idx = stream._idx
+        return cls._CHECK_MATCH(stream._text, idx, idx + 10) is not None
 
     def _parse(self, stream, indent):
-        next(stream)  # $
-        next(stream)  # {
+        stream.skip(2)  # ${
 
         self.number = _parse_number(stream)
 
@@ -276,7 +332,7 @@ class ChoicesToken(Token):
                 "Choices selection is not supported on $0"
             )
 
-        next(stream)  # |
+        stream.advance()  # |
 
         choices_text = _parse_till_unescaped_char(stream, "|")[0]
 
@@ -318,17 +374,21 @@ class EscapeCharToken(Token):
 
     """\\n."""
 
+    FIRST_CHAR = "\\"
+
     @classmethod
     def starts_here(cls, stream, chars=r"{}\$`"):
         """Returns true if this token starts at the current position in
         'stream'."""
-        cs = stream.peek(2)
-        if len(cs) == 2 and cs[0] == "\\" and cs[1] in chars:
-            return True
+        idx = stream._idx
+        text = stream._text
+        return (
+            idx + 1 < stream._len and text[idx] == "\\" and text[idx + 1] in chars
+        )
 
     def _parse(self, stream, indent):
-        next(stream)  # \
-        self.initial_text = next(stream)
+        stream.advance()  # \
+        self.initial_text = stream.advance()
 
     def __repr__(self):
         return "EscapeCharToken(%r,%r,%r)" % (self.start, self.end, self.initial_text)
@@ -338,14 +398,16 @@ class ShellCodeToken(Token):
 
     """`echo "hi"`"""
 
+    FIRST_CHAR = "`"
+
     @classmethod
     def starts_here(cls, stream):
         """Returns true if this token starts at the current position in
         'stream'."""
-        return stream.peek(1) == "`"
+        return stream.peek_char() == "`"
 
     def _parse(self, stream, indent):
-        next(stream)  # `
+        stream.advance()  # `
         self.code = _parse_till_unescaped_char(stream, "`")[0]
 
     def __repr__(self):
@@ -356,27 +418,28 @@ class PythonCodeToken(Token):
 
     """`!p snip.rv = "Hi"`"""
 
-    CHECK = re.compile(r"^`!p\s")
+    FIRST_CHAR = "`"
+    CHECK = re.compile(r"`!p\s")
+    _CHECK_MATCH = CHECK.match
 
     @classmethod
     def starts_here(cls, stream):
         """Returns true if this token starts at the current position in
         'stream'."""
-        return cls.CHECK.match(stream.peek(4)) is not None
+        idx = stream._idx
+        return cls._CHECK_MATCH(stream._text, idx, idx + 4) is not None
 
     def _parse(self, stream, indent):
-        for _ in range(3):
-            next(stream)  # `!p
-        if stream.peek() in "\t ":
-            next(stream)
+        stream.skip(3)  # `!p
+        if stream.peek_char() in ("\t", " "):
+            stream.advance()
 
         code = _parse_till_unescaped_char(stream, "`")[0]
 
         # Strip the indent if any
-        if len(indent):
-            lines = code.splitlines()
-            self.code = lines[0] + "\n"
-            self.code += "\n".join([l[len(indent) :] for l in lines[1:]])
+        if indent:
+            first_line, _, other_lines = code.partition("\n")
+            self.code = first_line + "\n" + _indent_regex(indent).sub("", other_lines)
         else:
             self.code = code
         self.indent = indent
@@ -389,17 +452,19 @@ class VimLCodeToken(Token):
 
     """`!v g:hi`"""
 
-    CHECK = re.compile(r"^`!v\s")
+    FIRST_CHAR = "`"
+    CHECK = re.compile(r"`!v\s")
+    _CHECK_MATCH = CHECK.match
 
     @classmethod
     def starts_here(cls, stream):
         """Returns true if this token starts at the current position in
         'stream'."""
-        return cls.CHECK.match(stream.peek(4)) is not None
+        idx = stream._idx
+        return cls._CHECK_MATCH(stream._text, idx, idx + 4) is not None
 
     def _parse(self, stream, indent):
-        for _ in range(4):
-            next(stream)  # `!v
+        stream.skip(4)  # `!v
         self.code = _parse_till_unescaped_char(stream, "`")[0]
 
     def __repr__(self):
@@ -414,20 +479,73 @@ class EndOfTextToken(Token):
         return "EndOfText(%r)" % self.end
 
 
+# Every token that can be found in snippet text. The lookup tables below are
+# derived from this list, so a new token must be added here.
+_TOKENS = [
+    EscapeCharToken,
+    VisualToken,
+    TransformationToken,
+    ChoicesToken,
+    TabStopToken,
+    MirrorToken,
+    PythonCodeToken,
+    VimLCodeToken,
+    ShellCodeToken,
+]
+
+# The patterns of all tokens starting with "$" are mutually exclusive, so one
+# alternation finds which of them (if any) starts at a position. Like their
+# starts_here(), it only looks at the next 10 characters.
+_DOLLAR_TOKENS_MATCH = re.compile(
+    "|".join(
+        "(?P<%s>%s)" % (token.__name__, token.CHECK.pattern)
+        for token in _TOKENS
+        if token.FIRST_CHAR == "$"
+    )
+).match
+
+
+# Matches every character a token can start with.
+_SIGILS_SEARCH = re.compile(
+    "[%s]" % re.escape("".join({token.FIRST_CHAR for token in _TOKENS}))
+).search
+
+
 def tokenize(text, indent, offset, allowed_tokens):
-    """Returns an iterator of tokens of 'text'['offset':] which is assumed to
+    """Returns a list of the tokens of 'text'['offset':] which is assumed to
     have 'indent' as the whitespace of the begging of the lines. Only
     'allowed_tokens' are considered to be valid tokens."""
     stream = _TextIterator(text, offset)
-    try:
-        while True:
-            done_something = False
-            for token in allowed_tokens:
+    tokens = []
+    # Only tokens starting with the current character can start here.
+    candidates = {}
+    for token in allowed_tokens:
+        candidates.setdefault(token.FIRST_CHAR, []).append(token)
+    # The tokens starting with "$" are told apart by a single regex.
+    dollar_tokens = {token.__name__: token for token in candidates.pop("$", ())}
+    while stream._idx < stream._len:
+        idx = stream._idx
+        char = text[idx]
+        if char == "$":
+            match = _DOLLAR_TOKENS_MATCH(text, idx, idx + 10)
+            token = dollar_tokens.get(match.lastgroup) if match else None
+        else:
+            for token in candidates.get(char, ()):
                 if token.starts_here(stream):
-                    yield token(stream, indent)
-                    done_something = True
                     break
-            if not done_something:
-                next(stream)
-    except StopIteration:
-        yield EndOfTextToken(stream, indent)
+            else:
+                token = None
+        if token is not None:
+            try:
+                tokens.append(token(stream, indent))
+            except _EndOfText:
+                # The token ran into the end of the text, e.g. a tabstop
+                # without its closing brace. It is dropped.
+                break
+            continue
+        # Nothing starts here. Skip ahead to the next character that could
+        # start a token.
+        match = _SIGILS_SEARCH(text, idx + 1)
+        stream.advance_to(match.start() if match else stream._len)
+    tokens.append(EndOfTextToken(stream, indent))
+    return tokens
@@ -40,6 +40,10 @@ _TOKEN_TO_TEXTOBJECT = {
     ChoicesToken: Choices,
 }
 
+# tokenize() only tries the tokens starting with the current character, and
+# tells the "$" tokens apart with a single regex, so their order here does not
+# matter. Among the "`" tokens it does: ShellCodeToken matches every "`" and
+# must come after PythonCodeToken and VimLCodeToken.
 __ALLOWED_TOKENS = [
     EscapeCharToken,
     VisualToken,
@@ -3,19 +3,14 @@
 
 """Utilities to deal with text."""
 
+import re
+
+_ESCAPED_CHAR = re.compile(r"\\(.)", re.DOTALL)
+
 
 def unescape(text):
     """Removes '\\' escaping from 'text'."""
-    rv = ""
-    i = 0
-    while i < len(text):
-        if i + 1 < len(text) and text[i] == "\\":
-            rv += text[i + 1]
-            i += 1
-        else:
-            rv += text[i]
-        i += 1
-    return rv
+    return _ESCAPED_CHAR.sub(r"\1", text)
 
 
 def escape(text, chars):
@@ -174,6 +174,12 @@ else:
     wanted = "    start b isbigger a end"
 
 
+class PythonCode_EmptyIndented(_VimTest):
+    snippets = ("test", "start `!p ` end")
+    keys = "    test" + EX
+    wanted = "    start  end"
+
+
 class PythonCode_SimpleAppend(_VimTest):
     snippets = (
         "test",